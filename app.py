@@ -1,14 +1,27 @@
 import os
 import streamlit as st
 import requests
-import json
+import orjson
 import sseclient
+from dotenv import load_dotenv
 import logging
+import time
+
+# BACKEND_URL and LOG_LEVEL can come from a .env file
+load_dotenv()
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# Re-render streamed text at most every RENDER_INTERVAL seconds,
+# or sooner once RENDER_MIN_CHARS of new text have arrived
+RENDER_INTERVAL = 0.1
+RENDER_MIN_CHARS = 512
+
+def render_due(last_render, pending_chars):
+    return time.monotonic() - last_render > RENDER_INTERVAL or pending_chars > RENDER_MIN_CHARS
+
 # Streamlit page configuration
 st.set_page_config(page_title="Deep Research", layout="wide")
 
@@ -72,47 +85,59 @@ if submit_button:
                     response = requests.post(url, json=payload, headers=headers, stream=True, timeout=120)
                     client = sseclient.SSEClient(response)
 
-                    plan_text = ""
                     results_text = ""
+                    results_rendered = 0
+                    results_last_render = time.monotonic()
                     report_buffer = []
-                    report_text = ""
+                    report_size = 0
+                    report_rendered = 0
+                    report_last_render = time.monotonic()
 
+                    # Every event carries a JSON payload, dispatch on its type
                     for event in client.events():
-                        if event.data:
-                            logger.debug(f"Received event data: {event.data}")
-                            data = event.data.strip()
-                            try:
-                                if data.startswith("Planning:"):
-                                    plan_data = data.replace("Planning:", "").strip()
-                                    plan_json = json.loads(plan_data)
-                                    plan_text = json.dumps(plan_json, indent=2)
-                                    plan_placeholder.json(plan_json)
-                                elif data.startswith("Search Results for"):
-                                    results_text += data + "\n\n"
-                                    results_placeholder.text(results_text)
-                                elif data.startswith("Quota exceeded") or data.startswith("API error"):
-                                    st.error(data)
-                                    break
-                                else:
-                                    # Buffer markdown chunks
-                                    report_buffer.append(data)
-                                    # Render only when a complete section is likely received
-                                    if data.endswith("\n") or len(report_buffer) > 5:
-                                        report_text = "\n".join(report_buffer)
-                                        report_placeholder.markdown(report_text, unsafe_allow_html=True)
-                            except json.JSONDecodeError as e:
-                                logger.error(f"JSON parsing error: {e} - Data: {data}")
-                                st.warning(f"Skipping malformed data: {data[:50]}...")
-                                continue
-
-                    # Final render of any remaining buffered markdown
-                    if report_buffer:
-                        report_text = "\n".join(report_buffer)
-                        report_placeholder.markdown(report_text, unsafe_allow_html=True)
+                        if not event.data:
+                            continue
+                        logger.debug("Received %s event: %s", event.event, event.data)
+                        try:
+                            data = orjson.loads(event.data)
+                        except orjson.JSONDecodeError as e:
+                            logger.error("JSON parsing error: %s - Data: %s", e, event.data)
+                            st.warning(f"Skipping malformed data: {event.data[:50]}...")
+                            continue
+
+                        if event.event == "plan":
+                            plan_placeholder.json(data)
+                        elif event.event == "search":
+                            results_text += f"Search Results for '{data['query']}':\n{orjson.dumps(data['results'], option=orjson.OPT_INDENT_2).decode()}\n\n"
+                            if render_due(results_last_render, len(results_text) - results_rendered):
+                                results_placeholder.text(results_text)
+                                results_rendered = len(results_text)
+                                results_last_render = time.monotonic()
+                        elif event.event == "report_chunk":
+                            report_buffer.append(data)
+                            report_size += len(data)
+                            if render_due(report_last_render, report_size - report_rendered):
+                                report_placeholder.markdown("".join(report_buffer), unsafe_allow_html=True)
+                                report_rendered = report_size
+                                report_last_render = time.monotonic()
+                        elif event.event == "error":
+                            if data.get("phase") == "search":
+                                st.warning(f"Error searching '{data.get('query')}': {data['message']}")
+                            elif data.get("phase") == "plan":
+                                st.warning(data["message"])
+                            else:
+                                st.error(data["message"])
+                                break
+
+                    # Final render of anything received since the last throttled update
+                    if len(results_text) > results_rendered:
+                        results_placeholder.text(results_text)
+                    if report_size > report_rendered:
+                        report_placeholder.markdown("".join(report_buffer), unsafe_allow_html=True)
 
                 except requests.exceptions.RequestException as e:
-                    logger.error(f"Request exception: {e}")
+                    logger.error("Request exception: %s", e)
                     st.error(f"Error connecting to backend: {e}")
                 except Exception as e:
-                    logger.error(f"Unexpected error: {e}")
+                    logger.error("Unexpected error: %s", e)
                     st.error(f"Unexpected error: {e}")
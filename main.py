@@ -1,18 +1,138 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
 import google.api_core.exceptions
-from tavily import TavilyClient
-import json
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_before_delay, wait_exponential_jitter
+from google.rpc import error_details_pb2
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+import httpx
+import hashlib
+import os
+import string
+import orjson
 import asyncio
 import logging
+import time
+import zlib
+
+# settings below are read from the environment, optionally via a .env file
+load_dotenv()
 
 # configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# ---------- clients ----------
+CLIENT_POOL_SIZE = 64
+CLIENT_POOL_TTL = 3600
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+
+@asynccontextmanager
+async def lifespan(app):
+    # one keep-alive pool for all outbound HTTP; Gemini clients, and the models
+    # built on them, are keyed by the caller's API key, so no key state is process-global
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+    app.state.gemini_clients = GeminiClientPool(maxsize=CLIENT_POOL_SIZE, ttl=CLIENT_POOL_TTL)
+    yield
+    await app.state.http.aclose()
+    await app.state.gemini_clients.aclose()
+
+class TavilyUnavailableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TavilyLimitError(Exception):
+    pass
+
+class TavilySearch:
+    # Tavily's REST search endpoint on the shared connection pool
+    def __init__(self, http, api_key):
+        self.http = http
+        self.api_key = api_key
+
+    async def search(self, **payload):
+        response = await self.http.post(
+            TAVILY_SEARCH_URL,
+            json=payload,
+            headers={"Authorization": f"Bearer {self.api_key}"}
+        )
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get("retry-after")
+            raise TavilyUnavailableError(
+                f"Tavily returned {response.status_code}",
+                float(retry_after) if retry_after and retry_after.isdigit() else None
+            )
+        if response.status_code in (432, 433):
+            raise TavilyLimitError(f"Tavily usage limit reached: {response.text}")
+        response.raise_for_status()
+        return response.json()
+
+class GeminiClient:
+    # one gRPC channel per API key, shared by every model built on that key
+    def __init__(self, api_key):
+        self.client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+        self.models = {}
+
+    def model(self, model_name, system_instruction=None):
+        key = (model_name, system_instruction)
+        model = self.models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            # bind the model to this key; left unset, the SDK would lazily build its
+            # client from the process-global genai.configure state shared by all callers.
+            # _async_client is private: this relies on google-generativeai==0.8.5, whose
+            # generate_content_async only builds a client when it is None
+            model._async_client = self.client
+            self.models[key] = model
+        return model
+
+    async def close(self, grace=None):
+        await self.client.transport.grpc_channel.close(grace)
+
+class GeminiClientPool(TTLCache):
+    # clients leaving the pool, by LRU eviction or TTL expiry, get their channel
+    # closed; calls already in flight on it have RESEARCH_TIMEOUT to finish
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.closing = set()
+
+    def popitem(self):
+        key, client = super().popitem()
+        self.retire(client)
+        return key, client
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for _, client in expired:
+            self.retire(client)
+        return expired
+
+    def retire(self, client):
+        task = asyncio.ensure_future(client.close(RESEARCH_TIMEOUT))
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def aclose(self):
+        self.expire()
+        for client in list(self.values()):
+            await client.close()
+        await asyncio.gather(*self.closing)
+
+def get_model(state, api_key, model_name, system_instruction=None):
+    client = state.gemini_clients.get(api_key)
+    if client is None:
+        client = state.gemini_clients[api_key] = GeminiClient(api_key)
+    return client.model(model_name, system_instruction)
+
+app = FastAPI(lifespan=lifespan)
 
 # ---------- schema ----------
 class ResearchQuery(BaseModel):
@@ -24,131 +144,631 @@ class ResearchQuery(BaseModel):
     gemini_api_key: str
     tavily_api_key: str
 
+# ---------- caching ----------
+PLAN_CACHE = TTLCache(maxsize=256, ttl=3600)
+REPORT_CACHE = TTLCache(maxsize=128, ttl=3600)
+# search results are stored as orjson bytes, so the bound is in bytes
+SEARCH_CACHE_BYTES = 16 * 1024 * 1024
+SEARCH_CACHE = TTLCache(maxsize=SEARCH_CACHE_BYTES, ttl=3600, getsizeof=len)
+REPLAY_CHUNK_SIZE = 512
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+PLAN_INFLIGHT = {}
+SEARCH_INFLIGHT = {}
+
+def cache_key(*parts):
+    return hashlib.md5("\x1f".join(parts).encode()).hexdigest()
+
+async def single_flight(inflight, key, factory):
+    # concurrent misses on the same key share one call; shield it so a
+    # disconnecting caller doesn't cancel the work for the others, but
+    # cancel it once the last caller has gone
+    flight = inflight.get(key)
+    if flight is None:
+        flight = inflight[key] = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+        flight["task"].add_done_callback(lambda task: end_flight(inflight, key, flight))
+    flight["waiters"] += 1
+    try:
+        return await asyncio.shield(flight["task"])
+    finally:
+        flight["waiters"] -= 1
+        if not flight["waiters"] and not flight["task"].done():
+            flight["task"].cancel()
+            end_flight(inflight, key, flight)
+
+def end_flight(inflight, key, flight):
+    # a newer flight may already hold the key once this one was abandoned
+    if inflight.get(key) is flight:
+        del inflight[key]
+    # retrieve the outcome, so a failure with no caller left isn't logged as unhandled
+    task = flight["task"]
+    if task.done() and not task.cancelled():
+        task.exception()
+
+# ---------- rate limiting ----------
+# per-process caps sized to the provider account; multiply by worker count
+# a report holds its slot for the whole stream, so plans get their own pool
+# rather than queueing behind long reports inside PLAN_TIMEOUT
+GEMINI_PLAN_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_PLAN_CONCURRENCY", "8")))
+GEMINI_REPORT_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "8")))
+TAVILY_SEM = asyncio.Semaphore(int(os.getenv("TAVILY_CONCURRENCY", "8")))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+# every caller brings their own Gemini key, so each key gets its own TPM budget
+TOKEN_BUCKETS = TTLCache(maxsize=256, ttl=3600)
+
+def get_token_bucket(api_key):
+    key = cache_key("Gemini", api_key)
+    bucket = TOKEN_BUCKETS.get(key)
+    if bucket is None:
+        bucket = TOKEN_BUCKETS[key] = TokenBucket(GEMINI_TPM)
+    return bucket
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# ---------- resilience ----------
+GEMINI_RETRYABLE = (
+    google.api_core.exceptions.ResourceExhausted,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.DeadlineExceeded
+)
+TAVILY_RETRYABLE = (httpx.TransportError, TavilyUnavailableError)
+TAVILY_TRIPS = TAVILY_RETRYABLE + (TavilyLimitError,)
+BREAKERS = TTLCache(maxsize=256, ttl=3600)
+RETRY_MAX_WAIT = 30
+backoff = wait_exponential_jitter(initial=1, max=RETRY_MAX_WAIT, jitter=2)
+
+def retry_delay_hint(exc):
+    if isinstance(exc, TavilyUnavailableError):
+        return exc.retry_after
+    # Google RPC errors carry the server's suggested delay as a RetryInfo detail
+    for detail in getattr(exc, "details", None) or []:
+        if isinstance(detail, error_details_pb2.RetryInfo):
+            return detail.retry_delay.seconds + detail.retry_delay.nanos / 1e9
+    return None
+
+def wait_for_retry_hint(retry_state):
+    # jittered backoff, but never sooner than the server asked for
+    delay = backoff(retry_state)
+    hint = retry_delay_hint(retry_state.outcome.exception())
+    if hint is not None:
+        delay = max(delay, hint)
+    return min(delay, RETRY_MAX_WAIT)
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, fail_max=5, reset_timeout=60):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpenError(f"{self.name} is unavailable, retry in {self.reset_timeout}s")
+        # half-open: let one call through, a single failure reopens the circuit
+        self.opened_at = None
+        self.failures = self.fail_max - 1
+
+    def on_success(self):
+        self.failures = 0
+
+    def on_failure(self):
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+
+def get_breaker(service, api_key):
+    key = cache_key(service, api_key)
+    breaker = BREAKERS.get(key)
+    if breaker is None:
+        breaker = BREAKERS[key] = CircuitBreaker(service)
+    return breaker
+
+async def guarded_call(breaker, trip_on, func, *args, **kwargs):
+    breaker.before_call()
+    try:
+        result = await func(*args, **kwargs)
+    except trip_on:
+        breaker.on_failure()
+        raise
+    breaker.on_success()
+    return result
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_for_retry_hint,
+    retry=retry_if_exception_type(GEMINI_RETRYABLE),
+    reraise=True
+)
+async def request_gemini(tokens, func, prompt, **kwargs):
+    # callers hold a Gemini slot; every attempt spends its estimated tokens
+    await tokens.acquire(estimate_tokens(prompt))
+    return await func(prompt, **kwargs)
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_for_retry_hint,
+    retry=retry_if_exception_type(TAVILY_RETRYABLE),
+    reraise=True
+)
+async def request_tavily(tavily, **kwargs):
+    async with TAVILY_SEM:
+        return await tavily.search(**kwargs)
+
+def retry_stop(budget):
+    # give up once the next attempt would start past the caller's phase timeout;
+    # nobody is left waiting for it, whatever Retry-After the server sent
+    return stop_after_attempt(4) | stop_before_delay(budget)
+
+# the breaker wraps the retries, so it records one outcome per call rather
+# than one per attempt; a single call's transient errors can't trip it alone
+async def call_gemini(breaker, tokens, budget, func, prompt, **kwargs):
+    attempts = request_gemini.retry_with(stop=retry_stop(budget))
+    return await guarded_call(breaker, GEMINI_RETRYABLE, attempts, tokens, func, prompt, **kwargs)
+
+async def call_tavily(breaker, tavily, **kwargs):
+    attempts = request_tavily.retry_with(stop=retry_stop(SEARCH_TIMEOUT))
+    return await guarded_call(breaker, TAVILY_TRIPS, attempts, tavily, **kwargs)
 
 # ---------- planning ----------
-async def generate_plan(query, thinking_model):
-    planning_prompt = f"""
-    Return a structured research plan for the topic: "{query}" as valid JSON only, with no additional text, markdown, or code fences. Example:
-    {{
-      "plan": "Overall research plan description",
-      "subtasks": [
-        {{
-          "subtask": "Description of subtask 1",
-          "search_query": "Specific search query for subtask 1"
-        }},
-        {{
-          "subtask": "Description of subtask 2",
-          "search_query": "Specific search query for subtask 2"
-        }}
-      ]
-    }}
-    Ensure at least two subtasks, each with a non-empty search_query relevant to the topic.
-    """
+PLAN_TEMPLATE = string.Template("""
+Create a structured research plan for the topic: "$query".
+Give an overall plan description and at least two subtasks, each with a non-empty search_query relevant to the topic.
+""")
+# Gemini's structured output guarantees the response parses into this shape
+PLAN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "plan": {"type": "STRING"},
+        "subtasks": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "subtask": {"type": "STRING"},
+                    "search_query": {"type": "STRING"}
+                },
+                "required": ["subtask", "search_query"]
+            }
+        }
+    },
+    "required": ["plan", "subtasks"]
+}
+PLAN_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=PLAN_SCHEMA
+)
+
+PLAN_TIMEOUT = float(os.getenv("PLAN_TIMEOUT", "30"))
+
+def plan_cache_key(query, thinking_model):
+    return cache_key(thinking_model.model_name, normalize_query(query))
+
+async def generate_plan(query, thinking_model, breaker, tokens):
+    key = plan_cache_key(query, thinking_model)
+    if key in PLAN_CACHE:
+        return PLAN_CACHE[key]
+    # the breaker is per API key, so only callers on the same key share a call;
+    # one key's failure or open circuit must not hand the others the fallback plan
+    return await single_flight(
+        PLAN_INFLIGHT, (key, breaker), lambda: request_plan(query, thinking_model, breaker, tokens, key)
+    )
+
+async def request_plan(query, thinking_model, breaker, tokens, key):
+    planning_prompt = PLAN_TEMPLATE.substitute(query=query)
     try:
-        response = thinking_model.generate_content(planning_prompt)
-        return json.loads(response.text)
+        async with GEMINI_PLAN_SEM:
+            response = await call_gemini(
+                breaker,
+                tokens,
+                PLAN_TIMEOUT,
+                thinking_model.generate_content_async,
+                planning_prompt,
+                generation_config=PLAN_GENERATION_CONFIG
+            )
+        plan = orjson.loads(response.text)
+        # the fallback plan below, used when the call itself fails, is never cached
+        PLAN_CACHE[key] = plan
+        return plan
     except Exception as e:
-        logger.error(f"Plan generation error: {e}")
-        return {
-            "plan": f"Default plan for {query}",
-            "subtasks": [
-                {"subtask": "Default subtask 1", "search_query": query},
-                {"subtask": "Default subtask 2", "search_query": f"{query} overview"}
-            ]
-        }
+        logger.error("Plan generation error: %s", e)
+        return default_plan(query)
+
+def default_plan(query):
+    return {
+        "plan": f"Default plan for {query}",
+        "subtasks": [
+            {"subtask": "Default subtask 1", "search_query": query},
+            {"subtask": "Default subtask 2", "search_query": f"{query} overview"}
+        ]
+    }
+
+# ---------- reporting ----------
+# identical for every request, so it is sent as the system instruction ahead
+# of the per-request content where the provider can reuse the prefix
+REPORT_SYSTEM_PROMPT = """
+You write detailed research reports in markdown format from a research plan and web search results.
+Structure the report as follows:
+- **Abstract**: Summary (100-150 words)
+- **Introduction**: Background & objective (150-200 words)
+- **Research Findings**: Each subtask as a section with synthesis (200-300 words each)
+- **Discussion**: Trends, comparison, limitations (200-250 words)
+- **Conclusion**: Key insights & future directions (150-200 words)
+- **References**: Numbered list [Title, URL: <url>]
+"""
+REPORT_TEMPLATE = string.Template("""
+Generate a detailed research report on $query using the following data:
+## Research Plan
+$plan
+## Subtasks and Search Results
+$summary
+""")
+
+NEAR_DUPLICATE_JACCARD = 0.8
+# Tavily returns SEARCH_MAX_RESULTS hits; only the best few per subtask go into the prompt
+PROMPT_RESULTS_PER_SUBTASK = 3
+
+def shingles(text, size=3):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def dedupe_results(search_results, limit=PROMPT_RESULTS_PER_SUBTASK):
+    # drop hits already used by an earlier subtask, by URL or by near-identical content;
+    # within a subtask the best-scored copy is seen first and at most limit are kept.
+    # a subtask left empty only by duplicates records which subtasks hold its hits;
+    # one already pointing at an earlier subtask's search is passed through
+    seen_urls = {}
+    seen_shingles = []
+    deduped = []
+    for item in search_results:
+        if item.get("duplicate_of"):
+            deduped.append(item)
+            continue
+        kept = []
+        duplicate_of = []
+        for r in sorted(item["results"], key=lambda r: -r.get("score", 0)):
+            if len(kept) >= limit:
+                break
+            url = r.get("url")
+            signature = shingles(r.get("content", "")[:500])
+            owner = seen_urls.get(url) if url else None
+            if owner is None and signature:
+                owner = next((
+                    subtask for other, subtask in seen_shingles
+                    if len(signature & other) / len(signature | other) > NEAR_DUPLICATE_JACCARD
+                ), None)
+            if owner is not None:
+                if owner not in duplicate_of:
+                    duplicate_of.append(owner)
+                continue
+            if url:
+                seen_urls[url] = item["subtask"]
+            if signature:
+                seen_shingles.append((signature, item["subtask"]))
+            kept.append(r)
+        deduped.append({**item, "results": kept, "duplicate_of": [] if kept else duplicate_of})
+    return deduped
+
+def build_search_summary(search_results):
+    # one flat pass and a single join instead of nested per-subtask joins
+    parts = []
+    for item in dedupe_results(search_results):
+        parts.append(f"Subtask: {item['subtask']}\nSearch Query: {item['search_query']}\nResults:")
+        if item["results"]:
+            for r in item["results"]:
+                parts.append(f"- {r['title']}: {r['content']} [URL: {r.get('url', 'Not Available')}]")
+        elif item["duplicate_of"]:
+            parts.append("Same results as subtask: " + "; ".join(item["duplicate_of"]))
+        else:
+            parts.append("No results found.")
+    return "\n".join(parts)
+
+# ---------- searching ----------
+SEARCH_MAX_RESULTS = 5
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "20"))
+SNIPPET_MAX_CHARS = 400
+
+def trim_snippet(text, limit=SNIPPET_MAX_CHARS):
+    # keep report prompts short: cut long snippets at the last full sentence
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    end = cut.rfind(". ")
+    return cut[:end + 1] if end > limit // 2 else cut.rstrip() + "..."
+
+async def search_cached(tavily, breaker, search_query, max_results=SEARCH_MAX_RESULTS):
+    key = cache_key(normalize_query(search_query), str(max_results))
+    encoded = SEARCH_CACHE.get(key)
+    if encoded is None:
+        # as with plans, only callers on the same Tavily key (and so the same
+        # breaker) share a call; the cached results themselves are key-independent
+        encoded = await single_flight(
+            SEARCH_INFLIGHT, (key, breaker), lambda: fetch_search(tavily, breaker, search_query, max_results, key)
+        )
+    # every caller gets its own copy of the results
+    return orjson.loads(encoded)
+
+async def fetch_search(tavily, breaker, search_query, max_results, key):
+    response = await call_tavily(breaker, tavily, query=search_query, max_results=max_results)
+    results = [{**r, "content": trim_snippet(r.get("content") or "")} for r in response["results"]]
+    encoded = SEARCH_CACHE[key] = orjson.dumps(results)
+    return encoded
+
+async def run_search(tavily, breaker, subtask):
+    search_query = subtask["search_query"]
+    item = {"search_query": search_query, "subtask": subtask["subtask"], "results": []}
+    try:
+        item["results"] = await asyncio.wait_for(search_cached(tavily, breaker, search_query), SEARCH_TIMEOUT)
+        return item, None
+    except asyncio.TimeoutError:
+        logger.error("Search timed out for %s", search_query)
+        return item, f"timed out after {SEARCH_TIMEOUT:g}s"
+    except Exception as e:
+        logger.error("Search error for %s: %s", search_query, e)
+        return item, e
 
 # ---------- streaming ----------
-async def stream_research(query, provider, thinking_model_name, task_model_name, search_provider, tavily_key, google_key):
-    genai.configure(api_key=google_key)
-    thinking_model = genai.GenerativeModel(thinking_model_name)
-    task_model = genai.GenerativeModel(task_model_name)
-    tavily = TavilyClient(api_key=tavily_key)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept-Encoding"}
+SSE_PING_SECONDS = 15
+SSE_GZIP_LEVEL = 1
+SSE_BUFFER_BYTES = 8192
+SSE_BUFFER_SECONDS = 0.05
+RESEARCH_TIMEOUT = float(os.getenv("RESEARCH_TIMEOUT", "180"))
 
-    plan = await generate_plan(query, thinking_model)
-    yield f"data: Planning: {json.dumps(plan, indent=2)}\n\n"
-    await asyncio.sleep(0.1)
+SSE_PING = b": ping\n\n"
 
-    search_results = []
-    for subtask in plan["subtasks"]:
-        search_query = subtask["search_query"]
+def sse_event(event, payload):
+    # frames go out as bytes; payloads are compact orjson, which never spans lines
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(payload) + b"\n\n"
+
+async def with_deadline(frames, seconds=RESEARCH_TIMEOUT):
+    # bound the whole pipeline; successive frames are produced in different
+    # tasks, so an asyncio.timeout() inside the generator can't do this
+    iterator = frames.__aiter__()
+    pending = None
+    deadline = time.monotonic() + seconds
+    try:
+        while True:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=max(deadline - time.monotonic(), 0))
+            if not done:
+                logger.error("Research timed out after %gs", seconds)
+                yield sse_event("error", {
+                    "phase": "research",
+                    "kind": "timeout",
+                    "message": f"Research timed out after {seconds:g}s"
+                })
+                break
+            try:
+                frame = pending.result()
+            except StopAsyncIteration:
+                break
+            pending = None
+            yield frame
+    finally:
+        await close_frames(iterator, pending)
+
+async def timed_batches(items, join, max_bytes, max_delay, idle_item=None, idle_seconds=None):
+    # merge items produced within max_delay of the first into one, flushing early
+    # at max_bytes; with idle_seconds set, emit idle_item while the source is quiet
+    iterator = items.__aiter__()
+    pending = None
+    buffer, size, deadline = [], 0, None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = idle_seconds if deadline is None else max(deadline - time.monotonic(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                try:
+                    item = pending.result()
+                except StopAsyncIteration:
+                    break
+                pending = None
+                buffer.append(item)
+                size += len(item)
+                if deadline is None:
+                    deadline = time.monotonic() + max_delay
+                if size < max_bytes:
+                    continue
+            elif not buffer:
+                yield idle_item
+                continue
+            yield join(buffer)
+            buffer, size, deadline = [], 0, None
+        if buffer:
+            yield join(buffer)
+    finally:
+        await close_frames(iterator, pending)
+
+def buffered_sse(frames, max_bytes=SSE_BUFFER_BYTES, max_delay=SSE_BUFFER_SECONDS, interval=SSE_PING_SECONDS):
+    # one ASGI send per burst of frames, and an SSE comment while the pipeline
+    # is quiet so proxies keep the connection open
+    return timed_batches(frames, b"".join, max_bytes, max_delay, SSE_PING, interval)
+
+async def close_frames(iterator, pending):
+    # a wrapped generator can only be closed once its outstanding __anext__ has settled
+    if pending is not None and not pending.done():
+        pending.cancel()
         try:
-            results = tavily.search(query=search_query, max_results=5)
-            search_results.append({
-                "search_query": search_query,
-                "subtask": subtask["subtask"],
-                "results": results["results"]
-            })
-            yield f"data: Search Results for '{search_query}': {json.dumps(results['results'], indent=2)}\n\n"
-        except Exception as e:
-            logger.error(f"Search error for {search_query}: {e}")
-            yield f"data: Error searching '{search_query}': {str(e)}\n\n"
-            search_results.append({
-                "search_query": search_query,
-                "subtask": subtask["subtask"],
-                "results": []
-            })
-        await asyncio.sleep(0.1)
+            await pending
+        except (asyncio.CancelledError, StopAsyncIteration):
+            pass
+    await iterator.aclose()
+
+async def gzip_frames(frames, level=SSE_GZIP_LEVEL):
+    # sync-flush after every frame so compression never holds an event back
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        async for frame in frames:
+            yield compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        await frames.aclose()
+
+REPORT_FLUSH_BYTES = 256
+REPORT_FLUSH_SECONDS = 0.15
+
+def coalesce(texts, max_bytes=REPORT_FLUSH_BYTES, max_delay=REPORT_FLUSH_SECONDS):
+    # merge small token chunks into fewer, larger SSE frames; a buffered chunk
+    # waits at most max_delay, even if the model goes quiet
+    return timed_batches(texts, "".join, max_bytes, max_delay)
+
+async def stream_research(state, query, provider, thinking_model_name, task_model_name, search_provider, tavily_key, google_key):
+    thinking_model = get_model(state, google_key, thinking_model_name)
+    tavily = TavilySearch(state.http, tavily_key)
+    gemini_breaker = get_breaker("Gemini", google_key)
+    gemini_tokens = get_token_bucket(google_key)
+    tavily_breaker = get_breaker("Tavily", tavily_key)
+
+    try:
+        plan = await asyncio.wait_for(generate_plan(query, thinking_model, gemini_breaker, gemini_tokens), PLAN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Plan generation timed out for %s", query)
+        yield sse_event("error", {
+            "phase": "plan",
+            "kind": "timeout",
+            "message": f"Planning timed out after {PLAN_TIMEOUT:g}s, using the default plan"
+        })
+        plan = default_plan(query)
+    yield sse_event("plan", plan)
+
+    # one search per distinct query: subtasks repeating a query share its task
+    searches = {}
+    try:
+        sections = []
+        for subtask in plan["subtasks"]:
+            key = normalize_query(subtask["search_query"])
+            if key not in searches:
+                searches[key] = asyncio.create_task(run_search(tavily, tavily_breaker, subtask))
+            sections.append((subtask, searches[key]))
+
+        # stream each section's results as soon as its search resolves
+        for next_done in asyncio.as_completed(list(searches.values())):
+            item, error = await next_done
+            search_query = item["search_query"]
+            if error is None:
+                yield sse_event("search", {"query": search_query, "results": item["results"]})
+            else:
+                yield sse_event("error", {"phase": "search", "query": search_query, "message": str(error)})
+    finally:
+        for task in searches.values():
+            task.cancel()
+
+    # keep plan order for the report regardless of completion order; a subtask
+    # sharing an earlier subtask's search points there instead of repeating it
+    search_results = []
+    first_subtask = {}
+    for subtask, task in sections:
+        item = {**task.result()[0], "subtask": subtask["subtask"]}
+        if task in first_subtask:
+            item = {**item, "results": [], "duplicate_of": [first_subtask[task]]}
+        else:
+            first_subtask[task] = subtask["subtask"]
+        search_results.append(item)
 
     # compile research report
-    summary = "\n".join([
-        f"Subtask: {s['subtask']}\nSearch Query: {s['search_query']}\nResults:\n" +
-        "\n".join([
-            f"- {r['title']}: {r['content']} [URL: {r.get('url', 'Not Available')}]" for r in s["results"]
-        ]) if s["results"] else "No results found."
-        for s in search_results
-    ])
-
-    report_prompt = f"""
-    Generate a detailed research report on {query} in markdown format using the following data:
-    ## Research Plan
-    {json.dumps(plan, indent=2)}
-    ## Search Results
-    {summary}
-
-    Structure the report as follows:
-    - **Abstract**: Summary (100-150 words)
-    - **Introduction**: Background & objective (150-200 words)
-    - **Research Findings**: Each subtask as a section with synthesis (200-300 words each)
-    - **Discussion**: Trends, comparison, limitations (200-250 words)
-    - **Conclusion**: Key insights & future directions (150-200 words)
-    - **References**: Numbered list [Title, URL: <url>]
-    """
+    summary = build_search_summary(search_results)
+
+    report_prompt = REPORT_TEMPLATE.substitute(query=query, plan=plan.get("plan", ""), summary=summary)
+    # looked up only now, so a client retired from the pool during planning or
+    # searching is not used for a new call
+    task_model = get_model(state, google_key, task_model_name, REPORT_SYSTEM_PROMPT)
 
     try:
         async def stream_report():
-            for chunk in task_model.generate_content(report_prompt, stream=True):
-                yield f"data: {chunk.text}\n\n"
-                await asyncio.sleep(0.1)
+            key = cache_key(task_model.model_name, report_prompt)
+            cached = REPORT_CACHE.get(key)
+            if cached is not None:
+                # replay the stored report without calling Gemini
+                for start in range(0, len(cached), REPLAY_CHUNK_SIZE):
+                    yield cached[start:start + REPLAY_CHUNK_SIZE]
+                    await asyncio.sleep(0)
+                return
 
-        async for chunk in stream_report():
-            yield chunk
+            parts = []
+            # hold the slot for the whole stream, not just the initial call
+            async with GEMINI_REPORT_SEM:
+                response = await call_gemini(gemini_breaker, gemini_tokens, RESEARCH_TIMEOUT, task_model.generate_content_async, report_prompt, stream=True)
+                async for chunk in response:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            # only complete reports are cached
+            REPORT_CACHE[key] = "".join(parts)
+
+        async for text in coalesce(stream_report()):
+            yield sse_event("report_chunk", text)
     except google.api_core.exceptions.ResourceExhausted as e:
-        yield f"data: Quota exceeded: {str(e)}\n\n"
+        yield sse_event("error", {"phase": "report", "kind": "quota", "message": str(e)})
+    except CircuitOpenError as e:
+        yield sse_event("error", {"phase": "report", "kind": "unavailable", "message": str(e)})
     except Exception as e:
-        yield f"data: Error generating report: {str(e)}\n\n"
+        yield sse_event("error", {"phase": "report", "kind": "error", "message": str(e)})
 
 # ---------- endpoint ----------
 @app.post("/api/sse")
-async def research_endpoint(body: ResearchQuery):
+async def research_endpoint(body: ResearchQuery, request: Request):
     try:
-
-        # Dynamically configure keys
-        genai.configure(api_key=query.gemini_api_key)
-        tavily = TavilyClient(api_key=query.tavily_api_key)
-
-        return StreamingResponse(
-            stream_research(
-                body.query,
-                body.provider,
-                body.thinking_model,
-                body.task_model,
-                body.search_provider,
-                body.tavily_api_key,
-                body.google_api_key
-            ),
-            media_type="text/event-stream"
-        )
+        frames = buffered_sse(with_deadline(stream_research(
+            request.app.state,
+            body.query,
+            body.provider,
+            body.thinking_model,
+            body.task_model,
+            body.search_provider,
+            body.tavily_api_key,
+            body.gemini_api_key
+        )))
+        headers = dict(SSE_HEADERS)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            frames = gzip_frames(frames)
+            headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(frames, media_type="text/event-stream", headers=headers)
     except Exception as e:
-        logger.error(f"Endpoint error: {e}")
+        logger.error("Endpoint error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+
+# ---------- server ----------
+if __name__ == "__main__":
+    import uvicorn
+
+    # each worker is a separate process with its own event loop and caches
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+        limit_concurrency=int(os.getenv("WORKER_CONNECTIONS", "1000")),
+        timeout_keep_alive=int(os.getenv("KEEP_ALIVE_SECONDS", "75"))
+    )